@@ -5,19 +5,43 @@ Provides cost-free image generation using Hugging Face Diffusers
 """
 
 import os
-import sys
+import gc
+import inspect
+import contextlib
 import logging
 import traceback
-from flask import Flask, request, jsonify, send_file
+
+# Must be set before torch initializes CUDA: expandable segments let the caching allocator
+# grow blocks in place instead of fragmenting across model switches and img2img runs
+# (max_split_size_mb caps fragmentation where expandable segments are unsupported, e.g. Windows)
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:512,garbage_collection_threshold:0.8"
+)
+
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 import torch
 from PIL import Image
+import numpy as np
 import io
-import base64
 import hashlib
-from datetime import datetime
-import json
-import re
+import time
+import queue
+import threading
+from collections import OrderedDict, deque, namedtuple
+from dataclasses import dataclass, field
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+try:
+    import pybase64 as base64  # SIMD (AVX2/NEON) codec, same API as the stdlib module
+except ImportError:
+    import base64
+
+try:
+    from blake3 import blake3 as cache_hash  # SIMD-accelerated, hashes cache keys several times faster
+except ImportError:
+    cache_hash = hashlib.sha256
 
 # Set Hugging Face cache to D drive to avoid filling C drive
 os.environ['HF_HOME'] = 'D:/HuggingFaceCache'
@@ -27,12 +51,16 @@ os.environ['TRANSFORMERS_CACHE'] = 'D:/HuggingFaceCache/transformers'
 # Set PyTorch cache to D drive as well
 os.environ['TORCH_HOME'] = 'D:/PyTorchCache'
 
+# Generated images are cached on D drive too, keyed by model/style/seed/prompt
+IMAGE_CACHE_DIR = 'D:/SDImageCache'
+
 # Create cache directories on D drive
 cache_dirs = [
     'D:/HuggingFaceCache',
     'D:/HuggingFaceCache/hub',
     'D:/HuggingFaceCache/transformers',
-    'D:/PyTorchCache'
+    'D:/PyTorchCache',
+    IMAGE_CACHE_DIR
 ]
 
 for cache_dir in cache_dirs:
@@ -47,113 +75,315 @@ logger.info(f"📁 Models will be cached on D drive: {os.environ['HF_HOME']}")
 logger.info(f"🔥 PyTorch cache on D drive: {os.environ['TORCH_HOME']}")
 logger.info(f"💾 This saves C drive space and uses your larger D drive storage")
 
+# Shapes are fixed at 512x512, so let cuDNN benchmark and keep the fastest conv kernels
+torch.backends.cudnn.benchmark = True
+
 app = Flask(__name__)
 CORS(app)
 
+# Align Your Steps (AYS) 10-step schedule for SD 1.5, tuned for DPM-Solver++
+AYS_TIMESTEPS_SD15 = [999, 850, 736, 645, 545, 455, 343, 233, 124, 24]
+
+# Latent Consistency distillation LoRA for SD 1.5, samples in 4-8 steps
+LCM_LORA_SD15 = "latent-consistency/lcm-lora-sdv1-5"
+
+# Prompt parts containing any of these survive CLIP truncation first
+PRIORITY_KEYWORDS = frozenset([
+    'character', 'scene', 'story', 'adventure', 'cartoon', 'anime', 'illustration',
+    'high quality', 'detailed', 'clean lines', 'bright colors', 'friendly',
+    'storybook', 'children', 'whimsical', 'magical', 'fantasy'
+])
+
+# Output encodings offered by /generate (WebP encodes ~3x faster than PNG)
+IMAGE_FORMATS = ("png", "webp")
+
+def encode_image(image, image_format="png", quality=85):
+    """Encode a PIL image into an in-memory buffer"""
+    buffer = io.BytesIO()
+    if image_format == "webp":
+        image.save(buffer, format="WEBP", quality=quality, method=4)  # method 4 trades ~1% size for speed
+    else:
+        image.save(buffer, format="PNG")
+    return buffer
+
+@dataclass(frozen=True, slots=True)
+class StyleConfig:
+    """Generation settings for one art style"""
+    model_id: str
+    positive_prompt: str
+    negative_prompt: str
+    steps: int
+    guidance_scale: float
+    lcm_steps: int = 6  # Used instead of steps/guidance_scale when the LCM-LoRA is fused
+    lcm_guidance_scale: float = 1.5
+    width: int = 512
+    height: int = 512
+    cache_threshold: float = 0.08
+    positive_prefix: str = field(init=False)  # positive_prompt joined once, ready for the user prompt
+
+    def __post_init__(self):
+        object.__setattr__(self, "positive_prefix", self.positive_prompt + ", ")
+
+# Style configurations optimized for various GPUs
+STYLE_CONFIGS = {
+    "cartoon": StyleConfig(
+        model_id="runwayml/stable-diffusion-v1-5",
+        positive_prompt="cartoon style, clean lines, bright colors, comic book art, illustration, animated style",
+        negative_prompt="realistic, photograph, photorealistic, blurry, low quality, distorted, nsfw, dark, scary",
+        steps=10,
+        guidance_scale=7.0
+    ),
+    "anime": StyleConfig(
+        model_id="runwayml/stable-diffusion-v1-5",
+        positive_prompt="anime style, cel shaded, detailed character design, manga art, japanese animation",
+        negative_prompt="realistic, photograph, 3d render, blurry, low quality, distorted, nsfw, western style",
+        steps=10,
+        guidance_scale=8.0
+    ),
+    "storybook": StyleConfig(
+        model_id="runwayml/stable-diffusion-v1-5",
+        positive_prompt="children's book illustration, watercolor style, soft colors, storybook art, whimsical, friendly",
+        negative_prompt="dark, scary, realistic, photograph, blurry, low quality, nsfw, violent",
+        steps=12,
+        guidance_scale=7.5
+    ),
+    "realistic": StyleConfig(
+        model_id="runwayml/stable-diffusion-v1-5",
+        positive_prompt="photorealistic, cinematic lighting, professional photography, detailed, high quality",
+        negative_prompt="cartoon, anime, artistic, painting, blurry, low quality, distorted, nsfw",
+        steps=12,
+        guidance_scale=6.0,
+        cache_threshold=0.04  # Stricter UNet cache reuse for photorealism
+    )
+}
+
+# A /generate request waiting for the GPU worker
+GenerationJob = namedtuple("GenerationJob", ["style", "prompt", "seed", "future"])
+
+# A /generate-scene request waiting for the GPU worker
+SceneJob = namedtuple(
+    "SceneJob",
+    ["style", "prompt", "image", "image_key", "image_b64", "strength", "steps", "guidance_scale", "seed", "future"]
+)
+
+# Any other GPU work (model switches) run one at a time on the same worker
+GpuCall = namedtuple("GpuCall", ["fn", "args", "future"])
+
+# Returned instead of queueing when the GPU worker is saturated
+QUEUE_FULL_RESULT = {"success": False, "error": "Generation queue is full, try again shortly", "queue_full": True}
+
+# Returned when a queued job isn't finished within job_timeout
+JOB_TIMEOUT_RESULT = {"success": False, "error": "Generation timed out waiting for the GPU", "timed_out": True}
+
+class FirstBlockCache:
+    """First-Block-Cache for the SD UNet.
+
+    Adjacent denoising steps produce nearly identical UNet outputs. The cheap
+    first block (conv_in) is run every step and its relative L1 change is
+    accumulated; while the change stays under the threshold the previous noise
+    prediction is reused instead of running the remaining UNet blocks.
+    """
+
+    def __init__(self, unet, threshold=0.08, max_consecutive_hits=2):
+        self.unet = unet
+        self.threshold = threshold
+        self.max_consecutive_hits = max_consecutive_hits
+        self.hits = 0
+        self.misses = 0
+        self._forward = unet.forward
+        unet.forward = self.forward
+        self.reset()
+
+    @classmethod
+    def attach(cls, unet):
+        """Wrap the UNet forward once and return its cache"""
+        cache = getattr(unet, "_first_block_cache", None)
+        if cache is None:
+            cache = cls(unet)
+            unet._first_block_cache = cache
+        return cache
+
+    def reset(self, threshold=None):
+        """Clear cached activations before a new generation"""
+        if threshold is not None:
+            self.threshold = threshold
+        self._previous_probe = None
+        self._cached_output = None
+        self._accumulated_change = 0.0
+        self._consecutive_hits = 0
+
+    def forward(self, sample, timestep, *args, **kwargs):
+        probe = self.unet.conv_in(sample)
+        previous_probe, self._previous_probe = self._previous_probe, probe
+
+        if self._cached_output is not None and previous_probe is not None and self.threshold > 0:
+            change = (probe - previous_probe).abs().mean() / previous_probe.abs().mean().clamp_min(1e-6)
+            self._accumulated_change += change.item()
+            if self._accumulated_change < self.threshold and self._consecutive_hits < self.max_consecutive_hits:
+                self._consecutive_hits += 1
+                self.hits += 1
+                return self._cached_output
+
+        output = self._forward(sample, timestep, *args, **kwargs)
+        self._cached_output = output
+        self._accumulated_change = 0.0
+        self._consecutive_hits = 0
+        self.misses += 1
+        return output
+
+class CudaGraphUNet:
+    """CUDA graph replay for the SD UNet.
+
+    Every style renders at a fixed 512x512, so each denoising step is the same
+    fixed-shape launch repeated 10+ times. The UNet forward is captured once per
+    input shape and replayed afterwards, which removes the per-kernel host launch
+    overhead. Inputs are copied into static tensors before each replay.
+    """
+
+    def __init__(self, unet):
+        self.unet = unet
+        self.enabled = True
+        self.graphs = {}
+        self._pool = None
+        self._forward = unet.forward
+        unet.forward = self.forward
+
+    @classmethod
+    def attach(cls, unet):
+        """Wrap the UNet forward once and return its graph runner"""
+        runner = getattr(unet, "_cuda_graph_runner", None)
+        if runner is None:
+            runner = cls(unet)
+            unet._cuda_graph_runner = runner
+        return runner
+
+    def capture(self, sample, timestep, encoder_hidden_states):
+        static = {
+            "sample": sample.clone(),
+            "timestep": timestep.clone(),
+            "encoder_hidden_states": encoder_hidden_states.clone()
+        }
+
+        # Run on a side stream first so lazy init and cuDNN autotuning stay out of the graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(2):
+                self._forward(**static, return_dict=False)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # All shapes share one memory pool so each extra batch size costs little VRAM
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self._pool):
+            static["output"] = self._forward(**static, return_dict=False)[0]
+        self._pool = graph.pool()
+        return graph, static
+
+    def forward(self, sample, timestep, encoder_hidden_states, *args, return_dict=True, **kwargs):
+        extra_inputs = args or any(value is not None for value in kwargs.values())
+        if not self.enabled or return_dict or extra_inputs or not sample.is_cuda:
+            return self._forward(sample, timestep, encoder_hidden_states, *args, return_dict=return_dict, **kwargs)
+
+        timestep = torch.as_tensor(timestep, device=sample.device)
+        key = (sample.shape, sample.dtype, timestep.shape, encoder_hidden_states.shape)
+        if key not in self.graphs:
+            try:
+                self.graphs[key] = self.capture(sample, timestep, encoder_hidden_states)
+                logger.info(f"📸 Captured UNet CUDA graph for sample shape {tuple(sample.shape)}")
+            except Exception as e:
+                logger.warning(f"⚠️ CUDA graph capture failed ({e}), using eager UNet")
+                self.enabled = False
+                return self._forward(sample, timestep, encoder_hidden_states, *args, return_dict=return_dict, **kwargs)
+
+        graph, static = self.graphs[key]
+        static["sample"].copy_(sample)
+        static["timestep"].copy_(timestep)
+        static["encoder_hidden_states"].copy_(encoder_hidden_states)
+        graph.replay()
+        # The static output is overwritten by the next replay, and callers may hold on to it
+        return (static["output"].clone(),)
+
 class LocalSDService:
     def __init__(self):
         self.pipeline = None
         self.img2img_pipeline = None  # For character-consistent scene generation
         self.current_model = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.models_cache = {}
+        self.use_ays_schedule = False
+        self.use_lcm = False
+        self.block_cache = None
+        self.block_cache_backend = None  # "cache-dit" or "first-block"
+        self.compiled = False
+        self.unet_quantization = None  # "nf4" (bitsandbytes), "qfloat8" (quanto) or None
+        self.offload_hooks = []
+        self.resident_vram_gb = 5.5  # Cards at least this large skip text encoder / VAE paging
+        self.image_cache = OrderedDict()  # cache key -> encoded image bytes, most recent last
+        self.image_cache_size = 32
+        self.disk_cache_max_files = 1000  # Oldest files in IMAGE_CACHE_DIR are evicted past this
+        self.image_cache_lock = threading.Lock()  # Shared by all waitress request threads
+        self.negative_embeds = {}  # style -> cached negative prompt embeddings
+        self.prefix_ids = {}  # style -> token ids of the style's positive prompt prefix
+        self.prompt_embeds_cache = OrderedDict()  # full prompt -> text encoder output, most recent last
+        self.prompt_embeds_cache_size = 64  # ~120KB of fp16 VRAM each
+        self.latent_cache = OrderedDict()  # character image hash -> VAE latents, most recent last
+        self.latent_cache_size = 16  # ~32KB of fp16 VRAM each at 512x512
+        self.job_queue = queue.Queue(maxsize=8)  # Overflowing requests get a 503 instead of piling up
+        self.job_timeout = 120  # Seconds a request waits on the GPU worker
+        self.max_batch = 4  # UNet cost is near-constant up to batch 4 at 512x512
+        self.max_batch_wait = 0.05  # Seconds to wait for more requests to join a batch
+        self.generators = [torch.Generator(device=self.device) for _ in range(self.max_batch)]
         
         # Style configurations optimized for various GPUs
-        self.style_configs = {
-            "cartoon": {
-                "model_id": "runwayml/stable-diffusion-v1-5",
-                "positive_prompt": "cartoon style, clean lines, bright colors, comic book art, illustration, animated style",
-                "negative_prompt": "realistic, photograph, photorealistic, blurry, low quality, distorted, nsfw, dark, scary",
-                "steps": 20,
-                "guidance_scale": 7.0,
-                "width": 512,
-                "height": 512
-            },
-            "anime": {
-                "model_id": "runwayml/stable-diffusion-v1-5",
-                "positive_prompt": "anime style, cel shaded, detailed character design, manga art, japanese animation",
-                "negative_prompt": "realistic, photograph, 3d render, blurry, low quality, distorted, nsfw, western style",
-                "steps": 25,
-                "guidance_scale": 8.0,
-                "width": 512,
-                "height": 512
-            },
-            "storybook": {
-                "model_id": "runwayml/stable-diffusion-v1-5",
-                "positive_prompt": "children's book illustration, watercolor style, soft colors, storybook art, whimsical, friendly",
-                "negative_prompt": "dark, scary, realistic, photograph, blurry, low quality, nsfw, violent",
-                "steps": 30,
-                "guidance_scale": 7.5,
-                "width": 512,
-                "height": 512
-            },
-            "realistic": {
-                "model_id": "runwayml/stable-diffusion-v1-5",
-                "positive_prompt": "photorealistic, cinematic lighting, professional photography, detailed, high quality",
-                "negative_prompt": "cartoon, anime, artistic, painting, blurry, low quality, distorted, nsfw",
-                "steps": 35,
-                "guidance_scale": 6.0,
-                "width": 512,
-                "height": 512
-            }
-        }
+        self.style_configs = STYLE_CONFIGS
         
         # Initialize with optimized model
         self.load_model("runwayml/stable-diffusion-v1-5")
+        
+        # Single GPU worker that micro-batches concurrent /generate requests
+        threading.Thread(target=self.batch_worker, name="sd-batch-worker", daemon=True).start()
     
     def optimize_prompt_for_clip(self, prompt, max_tokens=75):
         """Optimize prompt to fit within CLIP's 77 token limit (keeping 2 tokens for special tokens)"""
         try:
-            # Simple token estimation: roughly 1 token per 4 characters, but be conservative
-            # This is an approximation since we don't have the actual tokenizer here
-            estimated_tokens = len(prompt.split())  # Word-based estimation
+            # Count real CLIP BPE tokens; word counts undercount punctuation and rare words
+            tokenizer = self.pipeline.tokenizer
+            token_count = len(tokenizer(prompt, add_special_tokens=False).input_ids)
             
-            if estimated_tokens <= max_tokens:
+            if token_count <= max_tokens:
                 return prompt
             
-            logger.info(f"📝 Prompt too long ({estimated_tokens} words), optimizing for CLIP...")
-            
-            # Priority keywords for story generation
-            priority_keywords = [
-                'character', 'scene', 'story', 'adventure', 'cartoon', 'anime', 'illustration',
-                'high quality', 'detailed', 'clean lines', 'bright colors', 'friendly',
-                'storybook', 'children', 'whimsical', 'magical', 'fantasy'
-            ]
+            logger.info(f"📝 Prompt too long ({token_count} tokens), optimizing for CLIP...")
             
             # Split prompt into parts
-            parts = prompt.split(', ')
+            parts = [part.strip() for part in prompt.split(', ')]
             
             # Separate style prompts from content prompts
             style_parts = []
             content_parts = []
             
             for part in parts:
-                part = part.strip()
-                if any(keyword in part.lower() for keyword in priority_keywords):
+                part_lower = part.lower()
+                if any(keyword in part_lower for keyword in PRIORITY_KEYWORDS):
                     style_parts.append(part)
                 else:
                     content_parts.append(part)
             
-            # Reconstruct prompt with priorities
-            optimized_parts = []
+            # Reconstruct prompt with priorities, essential style parts first
+            optimized_parts = style_parts[:5]  # Limit to top 5 style elements
             
-            # Add essential style parts first
-            for part in style_parts[:5]:  # Limit to top 5 style elements
-                optimized_parts.append(part)
+            # Add content parts with token limit (+1 per part for the ", " separator)
+            remaining_tokens = max_tokens - len(tokenizer(', '.join(optimized_parts), add_special_tokens=False).input_ids)
+            content_ids = tokenizer(content_parts, add_special_tokens=False).input_ids if content_parts else []
             
-            # Add content parts with word limit
-            remaining_words = max_tokens - len(' '.join(optimized_parts).split())
-            
-            for part in content_parts:
-                part_words = len(part.split())
-                if remaining_words - part_words > 0:
+            for part, ids in zip(content_parts, content_ids):
+                part_tokens = len(ids) + 1
+                if remaining_tokens - part_tokens > 0:
                     optimized_parts.append(part)
-                    remaining_words -= part_words
+                    remaining_tokens -= part_tokens
                 else:
                     # Truncate this part to fit
-                    if remaining_words > 3:  # Only add if we have meaningful space
-                        truncated = ' '.join(part.split()[:remaining_words])
-                        optimized_parts.append(truncated)
+                    if remaining_tokens > 3:  # Only add if we have meaningful space
+                        optimized_parts.append(tokenizer.decode(ids[:remaining_tokens - 1]))
                     break
             
             optimized_prompt = ', '.join(optimized_parts)
@@ -173,6 +403,7 @@ class LocalSDService:
     
     def load_model(self, model_id):
         """Load or switch to a different model"""
+        previous_model = self.current_model
         try:
             if self.current_model == model_id and self.pipeline is not None:
                 logger.info(f"Model {model_id} already loaded")
@@ -180,42 +411,107 @@ class LocalSDService:
             
             logger.info(f"Loading model: {model_id}")
             
-            # Check if model is cached
-            if model_id in self.models_cache:
-                self.pipeline = self.models_cache[model_id]
-                logger.info(f"Loaded model from cache: {model_id}")
+            # Check the model exists before dropping the one that's serving requests
+            if not self.model_available(model_id):
+                logger.error(f"Model {model_id} not found locally or on the Hub, keeping {self.current_model}")
+                return False
+            
+            # Release the previous model before loading the next one; on a 6GB card two
+            # pipelines can't coexist, and HF's on-disk cache makes reloads cheap
+            if self.pipeline is not None:
+                self.unload_model()
+            
+            # Load model with GPU optimizations
+            from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+            quantization_kwargs = self.get_quantization_kwargs()
+            load_kwargs = dict(
+                torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+                safety_checker=None,  # Disable safety checker to save VRAM
+                requires_safety_checker=False,
+                **quantization_kwargs
+            )
+            if self.device == "cuda":
+                # fp16 weight files are half the bytes to read and skip the fp32 -> fp16 cast,
+                # which makes /switch-model noticeably faster
+                try:
+                    self.pipeline = StableDiffusionPipeline.from_pretrained(model_id, variant="fp16", **load_kwargs)
+                except (OSError, ValueError):
+                    logger.info(f"No fp16 weight files for {model_id}, loading full-precision weights")
+            if self.pipeline is None:
+                self.pipeline = StableDiffusionPipeline.from_pretrained(model_id, **load_kwargs)
+            self.unet_quantization = "nf4" if quantization_kwargs else None
+            self.use_lcm = self.load_lcm_lora()  # Fused before fp8 quantization touches the weights
+            if self.unet_quantization is None and self.device == "cuda":
+                self.quantize_unet_fp8()
+            self.load_fast_tokenizer(model_id)
+            
+            if self.use_lcm:
+                from diffusers import LCMScheduler
+                self.use_ays_schedule = False
+                self.pipeline.scheduler = LCMScheduler.from_config(self.pipeline.scheduler.config)
             else:
-                # Load model with GPU optimizations
-                from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
-                self.pipeline = StableDiffusionPipeline.from_pretrained(
-                    model_id,
-                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                    safety_checker=None,  # Disable safety checker to save VRAM
-                    requires_safety_checker=False
+                # DPM-Solver++ 2M converges in ~10 steps instead of 20-35
+                scheduler_kwargs = {"algorithm_type": "dpmsolver++", "solver_order": 2}
+                self.use_ays_schedule = (
+                    "timesteps" in inspect.signature(DPMSolverMultistepScheduler.set_timesteps).parameters
+                    and "timesteps" in inspect.signature(self.pipeline.__call__).parameters
                 )
-                
-                # Optimize for speed and memory
+                if not self.use_ays_schedule:
+                    # Older diffusers can't take a custom schedule, use Karras sigmas instead
+                    scheduler_kwargs["use_karras_sigmas"] = True
                 self.pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-                    self.pipeline.scheduler.config
+                    self.pipeline.scheduler.config, **scheduler_kwargs
                 )
+            
+            if self.device == "cuda":
+                # GPU optimizations for better memory management
+                logger.info("Applying GPU optimizations...")
+                # Decode the VAE per image and in tiles so its ~1GB transient spike
+                # no longer competes with the UNet for VRAM
+                self.pipeline.vae.enable_slicing()
+                self.pipeline.vae.enable_tiling()
+                self.apply_gpu_residency()  # UNet stays on GPU, small modules are paged
                 
-                if self.device == "cuda":
-                    # GPU optimizations for better memory management
-                    logger.info("Applying GPU optimizations...")
-                    self.pipeline.enable_model_cpu_offload()  # Efficient VRAM usage
-                    self.pipeline.enable_attention_slicing()  # Reduces VRAM usage
-                    
-                    # Skip xformers for compatibility across different GPUs
-                    logger.info("Skipping xformers for broader GPU compatibility")
+                if hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+                    # Diffusers already routes attention through SDPA (flash / memory-efficient
+                    # kernels); attention slicing would swap it for a slower sliced processor
+                    logger.info("Using PyTorch SDPA attention")
                 else:
-                    logger.info("Running on CPU - optimizations disabled")
-                
+                    self.pipeline.enable_attention_slicing()  # Reduces VRAM usage
+            
+                # Skip xformers for compatibility across different GPUs
+                logger.info("Skipping xformers for broader GPU compatibility")
+            else:
+                logger.info("Running on CPU - optimizations disabled")
                 self.pipeline = self.pipeline.to(self.device)
-                
-                # Cache models based on available memory
-                max_cached_models = 2 if self.device == "cuda" else 1
-                if len(self.models_cache) < max_cached_models:
-                    self.models_cache[model_id] = self.pipeline
+            
+            # NHWC layout lets cuDNN/oneDNN pick their faster convolution kernels
+            self.pipeline.unet.to(memory_format=torch.channels_last)
+            self.pipeline.vae.to(memory_format=torch.channels_last)
+            
+            # torch.compile needs Triton, which requires compute capability 7.0+
+            if self.device == "cuda" and torch.cuda.get_device_capability()[0] >= 7:
+                self.compile_pipeline()
+            
+            # Pre-Volta GPUs can't use torch.compile, so replay hand-captured CUDA graphs
+            # instead; quantized kernels aren't capture-safe, so quantized UNets stay eager
+            if self.device == "cuda" and not self.compiled and not self.unet_quantization:
+                CudaGraphUNet.attach(self.pipeline.unet)
+            
+            # Skip redundant UNet work between adjacent denoising steps
+            self.enable_block_cache()
+            
+            self.cache_negative_embeddings()
+            self.cache_prefix_ids()
+            
+            # Pay the torch.compile latency now, including after /switch-model,
+            # instead of on the first request
+            if self.compiled:
+                self.warmup()
+            
+            # Hand back staging buffers left over from loading, quantization and warmup
+            if self.device == "cuda":
+                torch.cuda.empty_cache()
             
             self.current_model = model_id
             logger.info(f"Successfully loaded model: {model_id}")
@@ -223,10 +519,448 @@ class LocalSDService:
             
         except Exception as e:
             logger.error(f"Failed to load model {model_id}: {str(e)}")
+            if previous_model and previous_model != model_id:
+                # Don't leave the service without a pipeline after a failed switch
+                logger.info(f"Restoring previous model: {previous_model}")
+                self.unload_model()
+                self.load_model(previous_model)
             return False
     
-    def generate_image(self, prompt, style="cartoon", seed=None):
-        """Generate image using the loaded model"""
+    def model_available(self, model_id):
+        """True if model_id is a local model directory, a Hub repo, or already in the HF cache"""
+        if os.path.isdir(model_id):
+            return True
+        try:
+            from huggingface_hub import model_info, try_to_load_from_cache
+        except ImportError:
+            return True  # Let from_pretrained report the error
+        try:
+            model_info(model_id)
+            return True
+        except Exception as e:
+            # Offline, or the id is wrong; a cached copy is still loadable
+            logger.info(f"Hub lookup for {model_id} failed ({e}), checking the local cache")
+            try:
+                return isinstance(try_to_load_from_cache(model_id, "model_index.json"), str)
+            except Exception:
+                return False  # Not even a valid repo id
+    
+    def unload_model(self):
+        """Drop every reference to the current pipeline and return its memory"""
+        self.pipeline = None
+        self.img2img_pipeline = None  # Built from the old model, rebuilt on demand
+        self.block_cache = None
+        self.block_cache_backend = None
+        self.negative_embeds = {}
+        self.prefix_ids = {}
+        self.prompt_embeds_cache.clear()
+        self.latent_cache.clear()  # Encoded by the old VAE
+        self.offload_hooks = []
+        self.current_model = None
+        if self.compiled:
+            torch._dynamo.reset()  # Compiled graphs keep the old UNet weights alive
+            self.compiled = False
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    
+    def get_quantization_kwargs(self):
+        """NF4-quantize the UNet with bitsandbytes when available (~1.7GB -> ~0.45GB VRAM)"""
+        if self.device != "cuda":
+            return {}
+        try:
+            import bitsandbytes
+            from diffusers.quantizers import PipelineQuantizationConfig
+        except ImportError:
+            logger.info("bitsandbytes/diffusers>=0.34 not installed - skipping NF4 UNet")
+            return {}
+        
+        logger.info("Quantizing UNet to NF4 with bitsandbytes")
+        return {
+            "quantization_config": PipelineQuantizationConfig(
+                quant_backend="bitsandbytes_4bit",
+                quant_kwargs={
+                    "load_in_4bit": True,
+                    "bnb_4bit_quant_type": "nf4",
+                    "bnb_4bit_compute_dtype": torch.float16
+                },
+                components_to_quantize=["unet"]
+            )
+        }
+    
+    def load_lcm_lora(self):
+        """Fuse the LCM-LoRA into the UNet so styles need 4-8 steps; False if it can't be applied"""
+        try:
+            self.pipeline.load_lora_weights(LCM_LORA_SD15)
+            self.pipeline.fuse_lora()
+            self.pipeline.unload_lora_weights()  # Keeps the fused weights, drops the LoRA layers
+        except Exception as e:
+            logger.warning(f"⚠️ LCM-LoRA unavailable ({e}), using DPM-Solver++")
+            try:
+                self.pipeline.unload_lora_weights()
+            except Exception:
+                pass
+            return False
+        
+        logger.info("⚡ Fused LCM-LoRA into UNet")
+        return True
+    
+    def quantize_unet_fp8(self):
+        """Fall back to fp8 UNet weights via optimum-quanto when bitsandbytes is unavailable"""
+        try:
+            from optimum.quanto import quantize, freeze, qfloat8
+        except ImportError:
+            logger.info("optimum-quanto not installed - loading fp16 UNet")
+            return
+        
+        # Halves the weight bytes read per denoising step; matmuls still run in fp16.
+        # Norm layers are tiny and precision-sensitive, so they stay unquantized
+        logger.info("Quantizing UNet weights to fp8 with optimum-quanto")
+        quantize(self.pipeline.unet, weights=qfloat8, exclude=["*norm*"])
+        freeze(self.pipeline.unet)
+        self.unet_quantization = "qfloat8"
+    
+    def apply_gpu_residency(self):
+        """Pin the UNet on the GPU and page only the text encoder and VAE from system RAM"""
+        from accelerate import cpu_offload_with_hook
+        
+        if self.unet_quantization != "nf4":  # bitsandbytes already placed the NF4 UNet on the GPU
+            self.pipeline.unet.to(self.device)
+        
+        # With a sliced/tiled VAE the whole fp16 pipeline peaks under ~5.5GB,
+        # so 6GB cards can keep every module resident and skip paging entirely
+        total_vram_gb = torch.cuda.get_device_properties(0).total_memory / 1024**3
+        if total_vram_gb >= self.resident_vram_gb:
+            logger.info(f"{total_vram_gb:.1f}GB VRAM - keeping text encoder and VAE resident")
+            self.pipeline.text_encoder.to(self.device)
+            self.pipeline.vae.to(self.device)
+            self.offload_hooks = []
+            return
+        
+        # The text encoder runs once before the denoising loop and the VAE once after it;
+        # chaining the hooks sends the text encoder back to RAM when the VAE is loaded
+        _, text_encoder_hook = cpu_offload_with_hook(self.pipeline.text_encoder, self.device)
+        _, vae_hook = cpu_offload_with_hook(self.pipeline.vae, self.device, prev_module_hook=text_encoder_hook)
+        self.offload_hooks = [text_encoder_hook, vae_hook]
+    
+    def offload_idle_modules(self):
+        """Return the paged modules to system RAM between requests"""
+        for hook in self.offload_hooks:
+            hook.offload()
+    
+    def compile_pipeline(self):
+        """Compile the UNet and VAE decoder into fused CUDA graphs"""
+        logger.info("Compiling UNet and VAE decoder with torch.compile...")
+        if self.unet_quantization:
+            # Quantized kernels cause graph breaks, so allow them and leave room for recompiles
+            torch._dynamo.config.cache_size_limit = 64
+        self.pipeline.unet = torch.compile(
+            self.pipeline.unet, mode="reduce-overhead", fullgraph=not self.unet_quantization,
+            dynamic=False  # Every style is 512x512, so specialize on the static shapes
+        )
+        # Compile the decoder module rather than vae.decode: the offload hook and the per-image
+        # slicing loop stay in eager Python, and slicing keeps the decoder input at batch 1
+        self.pipeline.vae.decoder = torch.compile(self.pipeline.vae.decoder, mode="reduce-overhead")
+        self.compiled = True
+    
+    def warmup(self):
+        """Run a throwaway 1-step generation per batch size so compiled graphs exist before serving"""
+        try:
+            logger.info("🔥 Warming up compiled pipeline...")
+            config = self.style_configs["cartoon"]
+            schedule, _ = self.get_schedule(config)
+            # Shapes are static, so each micro-batch size (x2 with CFG) is its own graph; run under
+            # run_batch's autocast so the compiled graphs' guards match serving
+            for batch_size in range(1, self.max_batch + 1):
+                if self.block_cache is not None:
+                    self.block_cache.reset(config.cache_threshold)  # Cached activations are per batch size
+                with torch.inference_mode(), self.autocast():
+                    self.pipeline(
+                        prompt=["warmup"] * batch_size,
+                        num_inference_steps=1,
+                        guidance_scale=schedule["guidance_scale"],
+                        width=config.width,
+                        height=config.height
+                    )
+            logger.info(f"Warmup complete for batch sizes 1-{self.max_batch}")
+        except Exception as e:
+            logger.warning(f"⚠️ Compiled warmup failed ({e}), falling back to eager mode")
+            self.pipeline.unet = self.pipeline.unet._orig_mod
+            self.pipeline.vae.decoder = self.pipeline.vae.decoder._orig_mod
+            self.enable_block_cache()
+            self.compiled = False
+    
+    def enable_block_cache(self):
+        """Use cache-dit's block cache when it supports the pipeline, else the built-in First-Block-Cache"""
+        try:
+            import cache_dit
+            cache_dit.enable_cache(self.pipeline)
+            self.block_cache = None
+            self.block_cache_backend = "cache-dit"
+            logger.info("Using cache-dit block cache")
+            return
+        except ImportError:
+            pass
+        except Exception as e:
+            logger.info(f"cache-dit can't wrap this pipeline ({e}), using First-Block-Cache")
+        
+        # Only the last UNet output is retained, so the cache adds one activation of VRAM
+        self.block_cache = FirstBlockCache.attach(self.pipeline.unet)
+        self.block_cache_backend = "first-block"
+    
+    def get_block_cache_stats(self):
+        """Hit statistics for whichever block cache is active"""
+        if self.block_cache_backend == "cache-dit":
+            import cache_dit
+            return {"backend": "cache-dit", "summary": str(cache_dit.summary(self.pipeline))}
+        if self.block_cache is None:
+            return None
+        
+        total = self.block_cache.hits + self.block_cache.misses
+        return {
+            "backend": "first-block",
+            "hits": self.block_cache.hits,
+            "misses": self.block_cache.misses,
+            "hit_rate": self.block_cache.hits / total if total else 0.0
+        }
+    
+    def cache_negative_embeddings(self):
+        """Encode each style's fixed negative prompt once instead of on every request"""
+        self.negative_embeds = {}
+        with torch.inference_mode():
+            for style, config in self.style_configs.items():
+                self.negative_embeds[style] = self.pipeline.encode_prompt(
+                    config.negative_prompt,
+                    device=self.pipeline._execution_device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=False
+                )[0]
+        self.offload_idle_modules()
+    
+    def load_fast_tokenizer(self, model_id):
+        """Swap in the Rust-backed CLIP tokenizer; the slow Python one dominates prompt prep"""
+        try:
+            from transformers import CLIPTokenizerFast
+            self.pipeline.tokenizer = CLIPTokenizerFast.from_pretrained(model_id, subfolder="tokenizer")
+        except Exception as e:
+            logger.warning(f"⚠️ Fast tokenizer unavailable, keeping default: {e}")
+    
+    def cache_prefix_ids(self):
+        """Tokenize each style's static positive prefix once so requests only tokenize the user text"""
+        tokenizer = self.pipeline.tokenizer
+        self.prefix_ids = {
+            style: tokenizer(config.positive_prefix, add_special_tokens=False).input_ids
+            for style, config in self.style_configs.items()
+        }
+    
+    def encode_prompts(self, style, prompts):
+        """Embeddings for a micro-batch of prompts, served from the LRU where possible"""
+        # Story scenes are often re-rendered with new seeds, so identical prompts recur
+        missing = [p for p in dict.fromkeys(prompts) if p not in self.prompt_embeds_cache]
+        if missing:
+            for prompt, embeds in zip(missing, self.run_text_encoder(style, missing)):
+                self.prompt_embeds_cache[prompt] = embeds
+        
+        for prompt in prompts:
+            self.prompt_embeds_cache.move_to_end(prompt)
+        prompt_embeds = torch.stack([self.prompt_embeds_cache[p] for p in prompts])
+        while len(self.prompt_embeds_cache) > self.prompt_embeds_cache_size:
+            self.prompt_embeds_cache.popitem(last=False)
+        return prompt_embeds
+    
+    def run_text_encoder(self, style, prompts):
+        """Encode prompts in one text encoder call, reusing the style's prefix ids"""
+        tokenizer = self.pipeline.tokenizer
+        prefix = self.style_configs[style].positive_prefix
+        max_content = tokenizer.model_max_length - 2  # Room for BOS/EOS
+        
+        # Prompts built from the style prefix only need their user remainder tokenized
+        remainders = [p[len(prefix):] if p.startswith(prefix) else p for p in prompts]
+        remainder_ids = tokenizer(remainders, add_special_tokens=False).input_ids
+        
+        input_ids = []
+        for prompt, ids in zip(prompts, remainder_ids):
+            if prompt.startswith(prefix):
+                ids = self.prefix_ids[style] + ids
+            # Same truncation and padding as the pipeline's own encode_prompt
+            ids = [tokenizer.bos_token_id] + ids[:max_content] + [tokenizer.eos_token_id]
+            input_ids.append(ids + [tokenizer.pad_token_id] * (tokenizer.model_max_length - len(ids)))
+        
+        input_ids = torch.tensor(input_ids, device=self.pipeline._execution_device)
+        return self.pipeline.text_encoder(input_ids)[0]
+    
+    def autocast(self):
+        """fp16 autocast on CUDA, bf16 on CPUs with native bf16 support, otherwise a no-op"""
+        if self.device == "cuda":
+            return torch.autocast("cuda", dtype=torch.float16)
+        if getattr(torch.cpu, "_is_avx512_bf16_supported", lambda: False)():
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+    
+    def get_schedule(self, config):
+        """Denoising kwargs and step count: LCM steps, else AYS timesteps when supported, else style steps"""
+        if self.use_lcm:
+            return {
+                "num_inference_steps": config.lcm_steps,
+                "guidance_scale": config.lcm_guidance_scale
+            }, config.lcm_steps
+        if self.use_ays_schedule:
+            return {
+                "timesteps": AYS_TIMESTEPS_SD15,
+                "guidance_scale": config.guidance_scale
+            }, len(AYS_TIMESTEPS_SD15)
+        return {
+            "num_inference_steps": config.steps,
+            "guidance_scale": config.guidance_scale
+        }, config.steps
+    
+    def run_on_gpu_worker(self, fn, *args, timeout=None):
+        """Run a function on the GPU worker thread and wait for its result (raises queue.Full when busy)"""
+        future = Future()
+        self.job_queue.put_nowait(GpuCall(fn, args, future))
+        return future.result(timeout=timeout)
+    
+    def batch_worker(self):
+        """Drain the job queue, coalescing compatible requests into one pipeline call"""
+        deferred = deque()
+        while True:
+            job = deferred.popleft() if deferred else self.job_queue.get()
+            
+            if isinstance(job, GpuCall):
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    job.future.set_result(job.fn(*job.args))
+                except Exception as e:
+                    job.future.set_exception(e)
+                continue
+            
+            batch = [job]
+            key = self.batch_key(job)
+            
+            # Collect more jobs with the same settings that arrive within the batching window
+            deadline = time.monotonic() + self.max_batch_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    next_job = self.job_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if not isinstance(next_job, GpuCall) and self.batch_key(next_job) == key:
+                    batch.append(next_job)
+                else:
+                    deferred.append(next_job)  # Different config - gets its own micro-batch
+            
+            # Skip jobs whose request already timed out and cancelled them
+            batch = [batch_job for batch_job in batch if batch_job.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            
+            try:
+                if isinstance(job, SceneJob):
+                    images = self.run_img2img_batch(batch)
+                else:
+                    images = self.run_batch(batch)
+                for batch_job, image in zip(batch, images):
+                    batch_job.future.set_result(image)
+            except Exception as e:
+                for batch_job in batch:
+                    batch_job.future.set_exception(e)
+    
+    def batch_key(self, job):
+        """Jobs with equal keys can share one pipeline call"""
+        if isinstance(job, SceneJob):
+            return ("img2img", job.style, job.strength, job.steps)
+        return ("txt2img", job.style)
+    
+    def run_batch(self, batch):
+        """Run one pipeline call for a micro-batch of same-style jobs"""
+        config = self.style_configs[batch[0].style]
+        schedule, _ = self.get_schedule(config)
+        
+        # One generator per image keeps seeded results independent of batch composition;
+        # the generators are reused so no RNG state is allocated on the request path
+        generators = self.generators[:len(batch)]
+        for generator, job in zip(generators, batch):
+            if job.seed is not None:
+                generator.manual_seed(job.seed)
+            else:
+                generator.seed()
+        
+        if len(batch) > 1:
+            logger.info(f"📦 Batching {len(batch)} requests with style: {batch[0].style}")
+        
+        if self.block_cache is not None:
+            self.block_cache.reset(config.cache_threshold)
+        with torch.inference_mode(), self.autocast():
+            result = self.pipeline(
+                prompt_embeds=self.encode_prompts(batch[0].style, [job.prompt for job in batch]),
+                negative_prompt_embeds=self.negative_embeds[batch[0].style].expand(len(batch), -1, -1),
+                width=config.width,
+                height=config.height,
+                generator=generators,
+                **schedule
+            )
+        self.offload_idle_modules()
+        return result.images
+    
+    def get_cached_image(self, key, image_format="png"):
+        """Look up a previously generated image (encoded bytes), memory first, then disk"""
+        with self.image_cache_lock:
+            if key in self.image_cache:
+                self.image_cache.move_to_end(key)
+                return self.image_cache[key]
+        
+        path = os.path.join(IMAGE_CACHE_DIR, f"{key}.{image_format}")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            image_bytes = f.read()
+        try:
+            os.utime(path)  # Eviction goes by mtime, so hits keep an entry fresh
+        except OSError:
+            pass
+        self.remember_image(key, image_bytes)
+        return image_bytes
+    
+    def cache_image(self, key, image_bytes, image_format="png"):
+        """Store a generated image on disk and in the in-memory LRU"""
+        try:
+            with open(os.path.join(IMAGE_CACHE_DIR, f"{key}.{image_format}"), "wb") as f:
+                f.write(image_bytes)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not write image cache entry: {e}")
+        self.prune_disk_cache()
+        self.remember_image(key, image_bytes)
+    
+    def prune_disk_cache(self):
+        """Delete the least recently used files once the on-disk image cache exceeds its cap"""
+        try:
+            entries = [entry for entry in os.scandir(IMAGE_CACHE_DIR) if entry.is_file()]
+        except OSError:
+            return
+        excess = len(entries) - self.disk_cache_max_files
+        if excess <= 0:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:excess]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass  # Already removed by another request thread
+    
+    def remember_image(self, key, image_bytes):
+        """Keep the most recently used images in memory to skip disk reads on hot keys"""
+        with self.image_cache_lock:
+            self.image_cache[key] = image_bytes
+            self.image_cache.move_to_end(key)
+            while len(self.image_cache) > self.image_cache_size:
+                self.image_cache.popitem(last=False)
+    
+    def generate_image(self, prompt, style="cartoon", seed=None, image_format="png", quality=85, binary=False):
+        """Generate image using the loaded model (binary=True returns the encoded buffer instead of base64)"""
         try:
             if self.pipeline is None:
                 return {"success": False, "error": "No model loaded"}
@@ -234,145 +968,240 @@ class LocalSDService:
             config = self.style_configs.get(style, self.style_configs["cartoon"])
             
             # Enhance prompt with style
-            full_prompt = f"{config['positive_prompt']}, {prompt}"
+            full_prompt = config.positive_prefix + prompt
             
             # Optimize prompt for CLIP token limit
             optimized_prompt = self.optimize_prompt_for_clip(full_prompt)
             
-            # Set seed for reproducibility
+            schedule, steps = self.get_schedule(config)
+            
+            metadata = {
+                "model": self.current_model,
+                "style": style,
+                "steps": steps,
+                "guidance_scale": schedule["guidance_scale"],
+                "size": f"{config.width}x{config.height}",
+                "original_prompt_words": len(full_prompt.split()),
+                "optimized_prompt_words": len(optimized_prompt.split()),
+                "prompt_optimized": len(full_prompt.split()) > len(optimized_prompt.split()),
+                "cache_hit": False
+            }
+            
+            # Seeded requests are deterministic, so repeats can be served from the image cache
+            cache_key = None
             if seed is not None:
-                generator = torch.Generator(device=self.device).manual_seed(seed)
-            else:
-                generator = None
+                cache_key = cache_hash(
+                    f"{self.current_model}|{style}|{seed}|{image_format}|{quality}|{prompt}".encode()
+                ).hexdigest()
+                cached_image = self.get_cached_image(cache_key, image_format)
+                if cached_image is not None:
+                    logger.info(f"⚡ Image cache hit for style: {style}, seed: {seed}")
+                    metadata["cache_hit"] = True
+                    return self.build_image_result(io.BytesIO(cached_image), image_format, metadata, binary)
             
             logger.info(f"Generating image with style: {style} (GPU optimized)")
-            logger.info(f"Original prompt length: {len(full_prompt.split())} words")
-            logger.info(f"Optimized prompt: {optimized_prompt[:100]}...")
-            logger.info("⏳ This should take 10-30 seconds on modern GPUs...")
-            
-            # Generate image
-            with torch.inference_mode():
-                result = self.pipeline(
-                    prompt=optimized_prompt,
-                    negative_prompt=config["negative_prompt"],
-                    num_inference_steps=config["steps"],
-                    guidance_scale=config["guidance_scale"],
-                    width=config["width"],
-                    height=config["height"],
-                    generator=generator
-                )
+            logger.debug("Original prompt: %s...", full_prompt[:100])
+            logger.debug("Optimized prompt: %s...", optimized_prompt[:100])
+            logger.info("⏳ This should take 5-15 seconds on modern GPUs...")
             
-            image = result.images[0]
+            # Hand off to the GPU worker, which batches requests of the same style together
+            future = Future()
+            self.job_queue.put_nowait(GenerationJob(
+                style if style in self.style_configs else "cartoon", optimized_prompt, seed, future
+            ))
+            try:
+                image = future.result(timeout=self.job_timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                logger.warning(f"⚠️ Generation timed out after {self.job_timeout}s")
+                return JOB_TIMEOUT_RESULT
             
-            # Convert to base64
-            buffer = io.BytesIO()
-            image.save(buffer, format="PNG")
-            img_str = base64.b64encode(buffer.getvalue()).decode()
+            buffer = encode_image(image, image_format, quality)
             
-            return {
-                "success": True,
-                "image": img_str,
-                "format": "png",
-                "metadata": {
-                    "model": self.current_model,
-                    "style": style,
-                    "steps": config["steps"],
-                    "guidance_scale": config["guidance_scale"],
-                    "size": f"{config['width']}x{config['height']}",
-                    "original_prompt_words": len(full_prompt.split()),
-                    "optimized_prompt_words": len(optimized_prompt.split()),
-                    "prompt_optimized": len(full_prompt.split()) > len(optimized_prompt.split())
-                }
-            }
+            if cache_key is not None:
+                self.cache_image(cache_key, buffer.getvalue(), image_format)
             
+            return self.build_image_result(buffer, image_format, metadata, binary)
+            
+        except queue.Full:
+            logger.warning("⚠️ Generation queue full, rejecting request")
+            return QUEUE_FULL_RESULT
         except Exception as e:
             logger.error(f"Image generation failed: {str(e)}")
             traceback.print_exc()
             return {"success": False, "error": str(e)}
     
-    def generate_image_from_character(self, prompt, character_image_base64, style="cartoon", seed=None, strength=0.7):
+    def build_image_result(self, buffer, image_format, metadata, binary=False):
+        """Wrap an encoded image either as raw bytes for send_file or as base64 for JSON"""
+        if binary:
+            buffer.seek(0)
+            return {"success": True, "_buffer": buffer, "format": image_format, "metadata": metadata}
+        
+        # Convert to base64 straight from the encoder's buffer (no intermediate bytes copy)
+        return {
+            "success": True,
+            "image": base64.b64encode(buffer.getbuffer()).decode(),
+            "format": image_format,
+            "metadata": metadata
+        }
+    
+    def load_img2img_pipeline(self):
+        """Initialize the img2img pipeline for the current model if not loaded"""
+        if self.img2img_pipeline is not None:
+            return
+        
+        logger.info("Loading img2img pipeline...")
+        from diffusers import StableDiffusionImg2ImgPipeline
+        
+        # Share the already-loaded UNet/VAE/text encoder/scheduler in place: no second copy
+        # of the weights, and the residency, quantization and caching setup carries over
+        self.img2img_pipeline = StableDiffusionImg2ImgPipeline(
+            **self.pipeline.components, requires_safety_checker=False
+        )
+        
+        logger.info("Img2img pipeline loaded successfully")
+    
+    def run_img2img_batch(self, batch):
+        """Run one img2img pipeline call for a micro-batch of scenes with matching settings"""
+        self.load_img2img_pipeline()
+        first = batch[0]
+        config = self.style_configs[first.style]
+        
+        # Per-image seeds on the pooled generators, as in run_batch
+        generators = self.generators[:len(batch)]
+        for generator, job in zip(generators, batch):
+            if job.seed is not None:
+                generator.manual_seed(job.seed)
+            else:
+                generator.seed()
+        
+        if len(batch) > 1:
+            logger.info(f"📦 Batching {len(batch)} scene requests with style: {first.style}")
+        
+        if self.block_cache is not None:
+            self.block_cache.reset(config.cache_threshold)
+        
+        # Generate scene images based on characters, under the same autocast as run_batch
+        with torch.inference_mode(), self.autocast():
+            result = self.img2img_pipeline(
+                prompt_embeds=self.encode_prompts(first.style, [job.prompt for job in batch]),
+                image=torch.cat([self.get_character_latents(job) for job in batch]),
+                strength=first.strength,  # How much to change from original (0.7 = good balance)
+                negative_prompt_embeds=self.negative_embeds[first.style].expand(len(batch), -1, -1),
+                num_inference_steps=first.steps,
+                guidance_scale=first.guidance_scale,
+                generator=generators
+            )
+        self.offload_idle_modules()
+        return result.images
+    
+    def decode_character_image(self, character_image_base64):
+        """Decode a base64 character image into a CPU uint8 RGB tensor (request thread, no CUDA)"""
+        from torchvision.io import decode_image, ImageReadMode
+        
+        image_data = base64.b64decode(character_image_base64)
+        try:
+            # libjpeg-turbo/libpng straight into a uint8 tensor, no PIL image round trip
+            image = decode_image(torch.frombuffer(bytearray(image_data), dtype=torch.uint8), mode=ImageReadMode.RGB)
+        except RuntimeError:
+            # Formats this torchvision build can't decode (e.g. WebP on older releases)
+            image = torch.from_numpy(np.array(Image.open(io.BytesIO(image_data)).convert("RGB"))).permute(2, 0, 1)
+        return image
+    
+    def get_character_latents(self, job):
+        """VAE latents for a scene's character image, encoded once per distinct image"""
+        latents = self.latent_cache.get(job.image_key)
+        if latents is not None:
+            self.latent_cache.move_to_end(job.image_key)
+            return latents
+        
+        # Normally decoded on the request thread; only an entry evicted since then needs decoding here
+        image = job.image
+        if image is None:
+            image = self.decode_character_image(job.image_b64)
+        
+        # Resize on the GPU in half precision instead of a single-threaded PIL bicubic on the CPU
+        config = self.style_configs[job.style]
+        dtype = torch.float16 if self.device == "cuda" else torch.float32
+        image = image.to(self.device, dtype=dtype).div_(255).unsqueeze(0)
+        if image.shape[-2:] != (config.height, config.width):
+            image = torch.nn.functional.interpolate(
+                image, size=(config.height, config.width), mode="bilinear", align_corners=False, antialias=True
+            )
+        vae = self.pipeline.vae
+        pixels = self.img2img_pipeline.image_processor.preprocess(image).to(
+            self.pipeline._execution_device, dtype=vae.dtype
+        )
+        # The distribution mean keeps a character's latents identical across scenes;
+        # 4-channel input makes the img2img pipeline skip its own VAE encode
+        latents = vae.encode(pixels).latent_dist.mode() * vae.config.scaling_factor
+        
+        self.latent_cache[job.image_key] = latents
+        while len(self.latent_cache) > self.latent_cache_size:
+            self.latent_cache.popitem(last=False)
+        return latents
+    
+    def generate_image_from_character(self, prompt, character_image_base64, style="cartoon", seed=None, strength=0.7,
+                                      image_format="png", quality=85):
         """Generate scene image using character image as base for consistency"""
         try:
-            # Initialize img2img pipeline if not loaded
-            if not hasattr(self, 'img2img_pipeline') or self.img2img_pipeline is None:
-                logger.info("Loading img2img pipeline...")
-                from diffusers import StableDiffusionImg2ImgPipeline
-                
-                # Use the same model but for img2img
-                self.img2img_pipeline = StableDiffusionImg2ImgPipeline.from_pretrained(
-                    self.current_model,
-                    torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                    safety_checker=None,
-                    requires_safety_checker=False
-                ).to(self.device)
-                
-                # Enable memory efficient attention
-                if hasattr(self.img2img_pipeline, "enable_xformers_memory_efficient_attention"):
-                    try:
-                        self.img2img_pipeline.enable_xformers_memory_efficient_attention()
-                    except:
-                        pass
-                
-                # Enable CPU offload for better memory management
-                if self.device == "cuda":
-                    self.img2img_pipeline.enable_sequential_cpu_offload()
-                
-                logger.info("Img2img pipeline loaded successfully")
-            
-            # Decode base64 character image
-            character_image_data = base64.b64decode(character_image_base64)
-            character_image = Image.open(io.BytesIO(character_image_data)).convert("RGB")
-            
             config = self.style_configs.get(style, self.style_configs["cartoon"])
             
+            # A story reuses one character image across many scenes, so its VAE latents are
+            # cached and repeat scenes skip the base64/PNG decode and the VAE encode
+            image_key = cache_hash(character_image_base64.encode()).hexdigest()
+            if image_key in self.latent_cache:
+                character_image = None
+            else:
+                character_image = self.decode_character_image(character_image_base64)
+            # Fewer steps for img2img
+            schedule, _ = self.get_schedule(config)
+            guidance_scale = schedule["guidance_scale"]
+            if self.use_lcm:
+                steps = max(4, int(config.lcm_steps * 0.8))
+            else:
+                steps = max(8, int(config.steps * 0.8))  # Never more than the style's txt2img steps
+            
             # Create scene prompt that focuses on the scene while maintaining character
-            scene_prompt = f"{config['positive_prompt']}, {prompt}, same character, consistent art style"
+            scene_prompt = config.positive_prefix + prompt + ", same character, consistent art style"
             
             # Optimize prompt for CLIP token limit
             optimized_scene_prompt = self.optimize_prompt_for_clip(scene_prompt)
             
-            # Set seed for reproducibility
-            if seed is not None:
-                generator = torch.Generator(device=self.device).manual_seed(seed)
-            else:
-                generator = None
-            
             logger.info(f"Generating scene with character consistency, style: {style}")
-            logger.info(f"Original scene prompt length: {len(scene_prompt.split())} words")
-            logger.info(f"Optimized scene prompt: {optimized_scene_prompt[:100]}...")
+            logger.debug("Original scene prompt: %s...", scene_prompt[:100])
+            logger.debug("Optimized scene prompt: %s...", optimized_scene_prompt[:100])
             logger.info(f"Strength: {strength} (higher = more scene variation)")
             logger.info("⏳ This should take 15-40 seconds on modern GPUs...")
             
-            # Generate scene image based on character
-            with torch.inference_mode():
-                result = self.img2img_pipeline(
-                    prompt=optimized_scene_prompt,
-                    image=character_image,
-                    strength=strength,  # How much to change from original (0.7 = good balance)
-                    negative_prompt=config["negative_prompt"],
-                    num_inference_steps=max(15, int(config["steps"] * 0.8)),  # Fewer steps for img2img
-                    guidance_scale=config["guidance_scale"],
-                    generator=generator
-                )
-            
-            scene_image = result.images[0]
+            # Scenes with the same style and strength share one img2img call
+            future = Future()
+            self.job_queue.put_nowait(SceneJob(
+                style if style in self.style_configs else "cartoon", optimized_scene_prompt,
+                character_image, image_key, character_image_base64, strength, steps, guidance_scale, seed, future
+            ))
+            try:
+                scene_image = future.result(timeout=self.job_timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                logger.warning(f"⚠️ Scene generation timed out after {self.job_timeout}s")
+                return JOB_TIMEOUT_RESULT
             
             # Convert to base64
-            buffer = io.BytesIO()
-            scene_image.save(buffer, format="PNG")
-            img_str = base64.b64encode(buffer.getvalue()).decode()
+            buffer = encode_image(scene_image, image_format, quality)
+            img_str = base64.b64encode(buffer.getbuffer()).decode()
             
             return {
                 "success": True,
                 "image": img_str,
-                "format": "png",
+                "format": image_format,
                 "metadata": {
                     "model": self.current_model,
                     "style": style,
                     "type": "scene_generation",
                     "strength": strength,
-                    "steps": max(15, int(config["steps"] * 0.8)),
-                    "guidance_scale": config["guidance_scale"],
+                    "steps": steps,
+                    "guidance_scale": guidance_scale,
                     "character_based": True,
                     "original_prompt_words": len(scene_prompt.split()),
                     "optimized_prompt_words": len(optimized_scene_prompt.split()),
@@ -380,6 +1209,9 @@ class LocalSDService:
                 }
             }
             
+        except queue.Full:
+            logger.warning("⚠️ Generation queue full, rejecting scene request")
+            return QUEUE_FULL_RESULT
         except Exception as e:
             logger.error(f"Character-based scene generation failed: {str(e)}")
             traceback.print_exc()
@@ -391,6 +1223,8 @@ class LocalSDService:
             "status": "ready" if self.pipeline else "not_ready",
             "device": self.device,
             "current_model": self.current_model,
+            "unet_quantization": self.unet_quantization,
+            "block_cache": self.get_block_cache_stats(),
             "cuda_available": torch.cuda.is_available(),
             "memory_usage": self.get_memory_usage()
         }
@@ -400,23 +1234,55 @@ class LocalSDService:
         if torch.cuda.is_available():
             return {
                 "gpu_memory_allocated": torch.cuda.memory_allocated() / 1024**3,  # GB
-                "gpu_memory_reserved": torch.cuda.memory_reserved() / 1024**3     # GB
+                "gpu_memory_reserved": torch.cuda.memory_reserved() / 1024**3,    # GB
+                "gpu_memory_peak": torch.cuda.max_memory_allocated() / 1024**3    # GB
             }
         return {"gpu_memory": "N/A - CPU only"}
 
 # Initialize service
 sd_service = LocalSDService()
 
+HEALTH_BODY = b'{"status":"healthy"}'
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
+    # Liveness probes can hit this at 10Hz, so skip jsonify and the timestamp
+    return Response(HEALTH_BODY, mimetype="application/json")
 
 @app.route('/status', methods=['GET'])
 def status():
     """Get service status"""
     return jsonify(sd_service.get_status())
 
+def get_output_options(data):
+    """Output format and quality from the JSON body, falling back to the query string"""
+    image_format = data.get('format', request.args.get('format', 'png'))
+    quality = int(data.get('quality', request.args.get('quality', 85, type=int)))
+    return image_format, quality
+
+def bool_arg(value):
+    """Parse 1/true/yes style flags from query strings or JSON"""
+    return str(value).lower() in ("1", "true", "yes")
+
+def valid_seed(seed):
+    """None or an int torch.Generator.manual_seed accepts (bools are rejected)"""
+    if seed is None:
+        return True
+    return isinstance(seed, int) and not isinstance(seed, bool) and -2**63 <= seed < 2**64
+
+def metadata_headers(metadata):
+    """Generation metadata as X-SD-* headers for raw image responses"""
+    return {f"X-SD-{key.replace('_', '-').title()}": str(value) for key, value in metadata.items()}
+
+def result_status(result):
+    """HTTP status for a generation result: 503 when the queue is full, 504 on timeout"""
+    if result.get("queue_full"):
+        return 503
+    if result.get("timed_out"):
+        return 504
+    return 200
+
 @app.route('/generate', methods=['POST'])
 def generate():
     """Generate image endpoint"""
@@ -425,12 +1291,32 @@ def generate():
         prompt = data.get('prompt', '')
         style = data.get('style', 'cartoon')
         seed = data.get('seed')
+        image_format, quality = get_output_options(data)
         
         if not prompt:
             return jsonify({"success": False, "error": "Prompt is required"}), 400
         
-        result = sd_service.generate_image(prompt, style, seed)
-        return jsonify(result)
+        # A bad seed would raise in the GPU worker and fail every request batched with it
+        if not valid_seed(seed):
+            return jsonify({"success": False, "error": "seed must be an integer"}), 400
+        
+        # raw=1 streams the encoded bytes instead of base64 JSON (~33% smaller, no decode on the client);
+        # format=binary is shorthand for raw PNG
+        binary = bool_arg(request.args.get('raw', data.get('raw', False))) or image_format == 'binary'
+        if image_format == 'binary':
+            image_format = 'png'
+        
+        if image_format not in IMAGE_FORMATS:
+            return jsonify({"success": False, "error": f"format must be one of: {', '.join(IMAGE_FORMATS + ('binary',))}"}), 400
+        
+        result = sd_service.generate_image(prompt, style, seed, image_format, quality, binary=binary)
+        if binary and result["success"]:
+            response = send_file(
+                result["_buffer"], mimetype=f"image/{image_format}", download_name=f"image.{image_format}"
+            )
+            response.headers.update(metadata_headers(result["metadata"]))
+            return response
+        return jsonify(result), result_status(result)
         
     except Exception as e:
         logger.error(f"Generate endpoint error: {str(e)}")
@@ -446,6 +1332,7 @@ def generate_scene_with_character():
         style = data.get('style', 'cartoon')
         seed = data.get('seed')
         strength = data.get('strength', 0.7)  # How much to vary from character image
+        image_format, quality = get_output_options(data)
         
         if not prompt:
             return jsonify({"success": False, "error": "Prompt is required"}), 400
@@ -453,18 +1340,26 @@ def generate_scene_with_character():
         if not character_image:
             return jsonify({"success": False, "error": "Character image (base64) is required"}), 400
         
+        if not valid_seed(seed):
+            return jsonify({"success": False, "error": "seed must be an integer"}), 400
+        
         # Validate strength parameter
         if not (0.1 <= strength <= 1.0):
             return jsonify({"success": False, "error": "Strength must be between 0.1 and 1.0"}), 400
         
+        if image_format not in IMAGE_FORMATS:
+            return jsonify({"success": False, "error": f"format must be one of: {', '.join(IMAGE_FORMATS)}"}), 400
+        
         result = sd_service.generate_image_from_character(
             prompt=prompt,
             character_image_base64=character_image,
             style=style,
             seed=seed,
-            strength=strength
+            strength=strength,
+            image_format=image_format,
+            quality=quality
         )
-        return jsonify(result)
+        return jsonify(result), result_status(result)
         
     except Exception as e:
         logger.error(f"Generate scene endpoint error: {str(e)}")
@@ -476,7 +1371,7 @@ def get_models():
     return jsonify({
         "styles": list(sd_service.style_configs.keys()),
         "current_model": sd_service.current_model,
-        "cached_models": list(sd_service.models_cache.keys())
+        "cached_models": [sd_service.current_model] if sd_service.current_model else []
     })
 
 @app.route('/switch-model', methods=['POST'])
@@ -489,13 +1384,15 @@ def switch_model():
         if not model_id:
             return jsonify({"success": False, "error": "model_id is required"}), 400
         
-        success = sd_service.load_model(model_id)
+        success = sd_service.run_on_gpu_worker(sd_service.load_model, model_id)
         
         if success:
             return jsonify({"success": True, "message": f"Switched to model: {model_id}"})
         else:
             return jsonify({"success": False, "error": f"Failed to load model: {model_id}"}), 500
             
+    except queue.Full:
+        return jsonify(QUEUE_FULL_RESULT), 503
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -508,15 +1405,24 @@ if __name__ == '__main__':
     if torch.cuda.is_available():
         logger.info(f"GPU: {torch.cuda.get_device_name()}")
         logger.info(f"GPU Memory: {torch.cuda.get_device_properties(0).total_memory / 1024**3:.1f} GB")
-        logger.info("🎯 GTX 1060 Optimizations: CPU Offloading + Attention Slicing")
+        logger.info("🎯 GTX 1060 Optimizations: Resident UNet + SDPA Attention")
         logger.info("📏 Image Size: 512x512 (perfect for 6GB VRAM)")
-        logger.info("⚡ Expected Speed: 10-30 seconds per image")
+        logger.info("⚡ Expected Speed: 5-15 seconds per image")
     logger.info("=" * 50)
     
-    # Run Flask app
-    app.run(
-        host='0.0.0.0',
-        port=int(os.environ.get('PORT', 7860)),  # Use 7860 to match the enhanced service
-        debug=False,
-        threaded=True
-    )
+    port = int(os.environ.get('PORT', 7860))  # Use 7860 to match the enhanced service
+    
+    # HTTP threads only parse requests and encode images; all CUDA work runs on the
+    # single GPU worker, so a production WSGI server just needs enough threads to wait
+    try:
+        from waitress import serve
+        logger.info(f"Serving with waitress on port {port}")
+        serve(app, host='0.0.0.0', port=port, threads=8)
+    except ImportError:
+        # Run Flask app
+        app.run(
+            host='0.0.0.0',
+            port=port,
+            debug=False,
+            threaded=True
+        )
@@ -6,28 +6,55 @@ This script demonstrates how to integrate the new image-to-image functionality
 into the story generation workflow for consistent character representation.
 """
 
+import os
+import hashlib
 import requests
 import base64
 import json
-from PIL import Image
-import io
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash  # Non-cryptographic, fine for cache keys (no adversary) and much faster than sha1
+    def cache_key_hash(data):
+        return xxhash.xxh3_128_hexdigest(data)
+except ImportError:
+    def cache_key_hash(data):
+        return hashlib.sha1(data).hexdigest()
 
 class CharacterConsistentSceneGenerator:
     """Helper class for generating scenes with character consistency"""
     
-    def __init__(self, sd_service_url="http://localhost:7860"):
+    def __init__(self, sd_service_url="http://localhost:7860", portrait_cache_dir="portrait_cache"):
         self.sd_service_url = sd_service_url
         self.character_image_cache = {}
+        self.character_image_ids = {}  # base64 portrait -> id the service keeps it under
+        self.portrait_cache_dir = portrait_cache_dir
+        self.portrait_format = "png"  # Lossless, since every scene is img2img'd from the portrait
+        self.image_format = "webp"  # Scenes are final output, so the service's smaller lossy WebP is fine
     
     def generate_character_portrait(self, character_description, style="cartoon", seed=None):
         """Generate the main character portrait that will be used for all scenes"""
         
+        # Unseeded portraits are random by design, so only seeded ones are reused
+        character_key = cache_key_hash(f"{character_description}|{style}|{seed}|{self.portrait_format}".encode())
+        cache_path = os.path.join(self.portrait_cache_dir, f"{character_key}.b64")
+        if seed is not None:
+            if character_key in self.character_image_cache:
+                print(f"♻️ Reusing character portrait: {character_description}")
+                return self.character_image_cache[character_key]
+            if os.path.exists(cache_path):
+                with open(cache_path) as f:
+                    self.character_image_cache[character_key] = f.read()
+                print(f"♻️ Loaded cached character portrait: {character_description}")
+                return self.character_image_cache[character_key]
+        
         prompt = f"portrait of {character_description}, centered, clear view, character design"
         
         payload = {
             "prompt": prompt,
             "style": style,
-            "seed": seed
+            "seed": seed,
+            "format": self.portrait_format
         }
         
         try:
@@ -36,9 +63,14 @@ class CharacterConsistentSceneGenerator:
             if response.status_code == 200:
                 result = response.json()
                 if result.get("success"):
-                    # Cache the character image for reuse
-                    character_key = f"{character_description}_{style}_{seed}"
+                    # Cache the character image for reuse, on disk too so re-runs skip the generation
                     self.character_image_cache[character_key] = result["image"]
+                    if result.get("image_id"):
+                        self.character_image_ids[result["image"]] = result["image_id"]
+                    if seed is not None:
+                        os.makedirs(self.portrait_cache_dir, exist_ok=True)
+                        with open(cache_path, "w") as f:
+                            f.write(result["image"])
                     
                     print(f"✅ Generated character portrait: {character_description}")
                     return result["image"]
@@ -59,16 +91,37 @@ class CharacterConsistentSceneGenerator:
         
         payload = {
             "prompt": scene_description,
-            "character_image": character_image_base64,
             "style": style,
             "strength": strength,
-            "seed": seed
+            "seed": seed,
+            "format": self.image_format,
+            "raw": True  # Raw image bytes instead of base64 JSON, where the service supports it
         }
         
+        # Reference a portrait the service still holds by id instead of re-uploading ~1MB of base64
+        character_image_id = self.character_image_ids.get(character_image_base64)
+        if character_image_id:
+            payload["character_image_id"] = character_image_id
+        else:
+            payload["character_image"] = character_image_base64
+        
         try:
-            response = requests.post(f"{self.sd_service_url}/generate-scene", json=payload, timeout=120)
+            # Concurrent scenes share one batched pipeline call, which takes longer than a single image
+            response = requests.post(f"{self.sd_service_url}/generate-scene", json=payload, timeout=300)
+            
+            if response.status_code == 404 and character_image_id:
+                # The service restarted or evicted the image - fall back to uploading it
+                self.character_image_ids.pop(character_image_base64, None)
+                payload.pop("character_image_id")
+                payload["character_image"] = character_image_base64
+                response = requests.post(f"{self.sd_service_url}/generate-scene", json=payload, timeout=300)
             
             if response.status_code == 200:
+                if response.headers.get("Content-Type", "").startswith("image/"):
+                    print(f"✅ Generated scene: {scene_description[:50]}...")
+                    # Callers get base64 either way; raw only saves the larger JSON transfer
+                    return base64.b64encode(response.content).decode()
+                
                 result = response.json()
                 if result.get("success"):
                     print(f"✅ Generated scene: {scene_description[:50]}...")
@@ -84,7 +137,7 @@ class CharacterConsistentSceneGenerator:
             print(f"❌ Scene generation error: {e}")
             return None
     
-    def generate_story_scenes(self, character_description, scenes, style="cartoon", base_seed=None):
+    def generate_story_scenes(self, character_description, scenes, style="cartoon", base_seed=None, max_parallel=4):
         """Generate all scenes for a story with character consistency"""
         
         print(f"🎭 Starting character-consistent story generation")
@@ -105,42 +158,48 @@ class CharacterConsistentSceneGenerator:
             print("❌ Failed to generate character portrait. Aborting story generation.")
             return []
         
-        # Save character portrait
-        char_image_data = base64.b64decode(character_image)
-        char_img = Image.open(io.BytesIO(char_image_data))
-        char_img.save("character_portrait.png")
-        print("💾 Character portrait saved as 'character_portrait.png'")
+        # Save character portrait (the encoded bytes as received, no decode/re-encode)
+        portrait_filename = f"character_portrait.{self.portrait_format}"
+        with open(portrait_filename, "wb") as f:
+            f.write(base64.b64decode(character_image))
+        print(f"💾 Character portrait saved as '{portrait_filename}'")
         
         # Step 2: Generate each scene using the character
         print(f"\n2️⃣ Generating {len(scenes)} scenes with character consistency...")
         story_images = []
         
-        for i, scene in enumerate(scenes, 1):
-            print(f"\n🎬 Scene {i}/{len(scenes)}: {scene[:50]}...")
-            
+        def generate_scene(i, scene):
             # Use incremental seeds for variety while maintaining consistency
             scene_seed = (base_seed + i) if base_seed else None
             
-            scene_image = self.generate_scene_with_character(
+            return self.generate_scene_with_character(
                 scene_description=scene,
                 character_image_base64=character_image,
                 style=style,
                 strength=0.7,  # Good balance between character consistency and scene variety
                 seed=scene_seed
             )
-            
+        
+        for i, scene in enumerate(scenes, 1):
+            print(f"🎬 Scene {i}/{len(scenes)}: {scene[:50]}...")
+        
+        # Requests in flight together get batched into one UNet call by the service
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            scene_images = list(executor.map(generate_scene, range(1, len(scenes) + 1), scenes))
+        
+        for i, (scene, scene_image) in enumerate(zip(scenes, scene_images), 1):
             if scene_image:
                 # Save scene image
-                scene_image_data = base64.b64decode(scene_image)
-                scene_img = Image.open(io.BytesIO(scene_image_data))
-                scene_img.save(f"scene_{i:02d}.png")
-                print(f"💾 Scene {i} saved as 'scene_{i:02d}.png'")
+                filename = f"scene_{i:02d}.{self.image_format}"
+                with open(filename, "wb") as f:
+                    f.write(base64.b64decode(scene_image))
+                print(f"💾 Scene {i} saved as '{filename}'")
                 
                 story_images.append({
                     "scene_number": i,
                     "description": scene,
                     "image": scene_image,
-                    "filename": f"scene_{i:02d}.png"
+                    "filename": filename
                 })
             else:
                 print(f"❌ Failed to generate scene {i}")
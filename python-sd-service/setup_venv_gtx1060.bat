@@ -8,7 +8,7 @@ echo.
 REM Check if Python is installed
 python --version >nul 2>&1
 if errorlevel 1 (
-    echo ❌ Python not found! Please install Python 3.8+ from python.org
+    echo ❌ Python not found! Please install Python 3.10+ from python.org
     pause
     exit /b 1
 )
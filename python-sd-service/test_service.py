@@ -4,12 +4,76 @@ Test script for Free Python Stable Diffusion Service
 Verifies the service is working correctly before integration
 """
 
+import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
+try:
+    from orjson import loads as json_loads, dumps as json_dumps  # Faster on the multi-MB base64 /generate response
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 import time
-import base64
-from PIL import Image
-import io
+import re
+from email.parser import BytesParser
+try:
+    import pybase64 as base64  # SIMD base64 decoder, several times faster on the image payload
+except ImportError:
+    import base64
+from concurrent.futures import ThreadPoolExecutor
+
+# One keep-alive connection pool shared by every probe instead of a new connection per call.
+# Stays on HTTP/1.1: waitress and the Flask dev server don't speak HTTP/2, and clients only
+# negotiate it over TLS, so the parallel probes each get their own pooled connection instead
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+# The base64 payload of a JSON /generate response, pulled out without building a str for it
+IMAGE_FIELD = re.compile(rb'"image"\s*:\s*"([A-Za-z0-9+/=]*)"')
+
+READY_TIMEOUT = 30  # Seconds to wait for a warming service before generating
+STORYFORGE_URL = "http://localhost:3001"
+PROBE_TTL = 1.0  # Seconds a GET probe's response is reused
+_probe_cache = {}
+
+def post_json(url, payload, headers=None, **kwargs):
+    """POST a JSON body serialized by orjson (when installed) straight to bytes"""
+    return SESSION.post(url, data=json_dumps(payload), headers={"Content-Type": "application/json", **(headers or {})}, **kwargs)
+
+def cached_get(url, timeout=5):
+    """GET a probe endpoint, reusing a response fetched within the last PROBE_TTL seconds"""
+    now = time.monotonic()
+    cached = _probe_cache.get(url)
+    if cached and now - cached[0] < PROBE_TTL:
+        return cached[1]
+    response = SESSION.get(url, timeout=timeout)
+    _probe_cache[url] = (now, response)
+    return response
+
+def save_image(data, path):
+    """Write an image in a single unbuffered write to a file preallocated to its final size"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):  # Linux/Unix only
+            os.posix_fallocate(fd, 0, len(data))
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def wait_until_ready(base_url):
+    """Poll /status until the model is loaded, so the generation request doesn't queue behind startup"""
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            if json_loads(cached_get(f"{base_url}/status").content).get('status') == 'ready':
+                return True
+        except Exception:
+            pass
+        time.sleep(0.5)
+    return False
 
 def test_service():
     """Run comprehensive tests on the Python SD service"""
@@ -18,10 +82,16 @@ def test_service():
     print("🧪 Testing Free Python Stable Diffusion Service")
     print("=" * 50)
     
+    # Tests 1-3 are independent GETs, so fire them together and report in order
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        health_probe = executor.submit(cached_get, f"{base_url}/health")
+        status_probe = executor.submit(cached_get, f"{base_url}/status")
+        models_probe = executor.submit(cached_get, f"{base_url}/models")
+    
     # Test 1: Health Check
     print("1. Health Check...")
     try:
-        response = requests.get(f"{base_url}/health", timeout=5)
+        response = health_probe.result()
         if response.status_code == 200:
             print("   ✅ Service is healthy")
         else:
@@ -35,8 +105,8 @@ def test_service():
     # Test 2: Status Check
     print("2. Status Check...")
     try:
-        response = requests.get(f"{base_url}/status", timeout=5)
-        status = response.json()
+        response = status_probe.result()
+        status = json_loads(response.content)
         print(f"   Device: {status.get('device', 'unknown')}")
         print(f"   Model: {status.get('current_model', 'none')}")
         print(f"   CUDA Available: {status.get('cuda_available', False)}")
@@ -51,8 +121,8 @@ def test_service():
     # Test 3: Available Styles
     print("3. Available Styles...")
     try:
-        response = requests.get(f"{base_url}/models", timeout=5)
-        models = response.json()
+        response = models_probe.result()
+        models = json_loads(response.content)
         styles = models.get('styles', [])
         print(f"   Available styles: {', '.join(styles)}")
         print("   ✅ Styles loaded successfully")
@@ -64,30 +134,62 @@ def test_service():
     print("4. Image Generation Test...")
     test_prompt = "a cute cartoon cat sitting in a garden, children's book illustration"
     
+    if not wait_until_ready(base_url):
+        print(f"   ❌ Service not ready after {READY_TIMEOUT}s")
+        return False
+    
     try:
         print(f"   Generating: '{test_prompt}'")
         print("   ⏳ This may take 30-60 seconds on first run...")
         
-        start_time = time.time()
-        response = requests.post(f"{base_url}/generate", 
-            json={
+        start_time = time.perf_counter_ns()  # Monotonic, unaffected by clock adjustments
+        # Ask for the raw PNG (format=binary): no base64 on the wire and nothing to decode
+        response = post_json(f"{base_url}/generate",
+            {
                 "prompt": test_prompt,
-                "style": "cartoon"
+                "style": "cartoon",
+                "format": "binary"
             },
-            timeout=120  # 2 minute timeout
+            headers={"Accept": "image/png"},
+            timeout=120,  # 2 minute timeout
+            stream=True  # Read the body as it arrives instead of buffering it whole
         )
-        end_time = time.time()
+        end_time = time.perf_counter_ns()
         
         if response.status_code == 200:
-            result = response.json()
-            if result.get('success'):
-                generation_time = end_time - start_time
+            if response.headers.get('Content-Type', '').startswith('image/png'):
+                generation_time = (end_time - start_time) / 1e9
+                print(f"   ✅ Image generated successfully in {generation_time:.1f}s")
+                
+                # The response body already is the PNG file; copy it to disk chunk by chunk
+                with open('test_output.png', 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        f.write(chunk)
+                print("   💾 Test image saved as 'test_output.png'")
+                
+                # Metadata comes back as X-SD-* headers
+                print(f"   Model: {response.headers.get('X-SD-Model', 'unknown')}")
+                print(f"   Steps: {response.headers.get('X-SD-Steps', 'unknown')}")
+                print(f"   Size: {response.headers.get('X-SD-Size', 'unknown')}")
+                
+                return True
+            
+            # Servers without raw output answer with base64 JSON. Slice the image out and only
+            # parse the small remainder, so the payload never becomes a 1MB+ Python str
+            content = response.content
+            image_field = IMAGE_FIELD.search(content)
+            if image_field:
+                img_b64 = image_field.group(1)
+                content = content[:image_field.start(1)] + content[image_field.end(1):]
+            result = json_loads(content)
+            if result.get('success') and image_field:
+                generation_time = (end_time - start_time) / 1e9
                 print(f"   ✅ Image generated successfully in {generation_time:.1f}s")
                 
-                # Save test image
-                img_data = base64.b64decode(result['image'])
-                img = Image.open(io.BytesIO(img_data))
-                img.save('test_output.png')
+                # Save test image (already PNG bytes, no need to decode and re-encode it)
+                # pybase64's SIMD decoder validates in-flight; validate=False would add a filtering pass
+                img_data = base64.b64decode(img_b64, validate=True)
+                save_image(img_data, 'test_output.png')
                 print("   💾 Test image saved as 'test_output.png'")
                 
                 # Show metadata
@@ -112,19 +214,73 @@ def test_service():
         print(f"   ❌ Generation error: {e}")
         return False
 
-def test_integration():
-    """Test integration with StoryForge"""
+def test_batch_generation():
+    """Generate a small storyboard in one /generate-batch request"""
+    
+    base_url = "http://localhost:8080"
+    print("5. Batch Generation Test...")
+    test_prompts = [
+        "a cute cartoon cat reading a book under a tree",
+        "a cute cartoon cat chasing butterflies in a meadow"
+    ]
+    
+    try:
+        print(f"   Generating {len(test_prompts)} images in one request...")
+        start_time = time.perf_counter_ns()
+        # One request for the whole storyboard: the service runs the prompts as one UNet batch
+        response = post_json(f"{base_url}/generate-batch",
+            {
+                "prompts": test_prompts,
+                "style": "cartoon",
+                "raw": True  # multipart/mixed with one raw PNG part per image
+            },
+            timeout=300  # Several images on CPU
+        )
+        generation_time = (time.perf_counter_ns() - start_time) / 1e9
+        
+        if response.status_code == 404:
+            print("   ⚠️ Service has no /generate-batch endpoint, skipping")
+            return True
+        
+        content_type = response.headers.get('Content-Type', '')
+        if response.status_code == 200 and content_type.startswith('multipart/mixed'):
+            # The email parser needs the boundary from the HTTP header in front of the body
+            message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + response.content)
+            images = [part.get_payload(decode=True) for part in message.walk() if part.get_content_maintype() == 'image']
+        else:
+            result = json_loads(response.content)
+            if response.status_code != 200 or not result.get('success'):
+                print(f"   ❌ Batch generation failed: {result.get('error', response.status_code)}")
+                return False
+            images = [base64.b64decode(entry['image'], validate=True) for entry in result['images']]
+        
+        print(f"   ✅ {len(images)} images generated in {generation_time:.1f}s")
+        for i, img_data in enumerate(images, 1):
+            save_image(img_data, f'test_batch_{i}.png')
+        print(f"   💾 Saved as 'test_batch_1.png'..'test_batch_{len(images)}.png'")
+        return True
+        
+    except requests.exceptions.Timeout:
+        print("   ❌ Batch generation timed out (>5 minutes)")
+        return False
+    except Exception as e:
+        print(f"   ❌ Batch generation error: {e}")
+        return False
+
+def test_integration(services_probe=None):
+    """Test integration with StoryForge (services_probe: an already-started status request)"""
     print("\n🔗 Testing StoryForge Integration")
     print("=" * 50)
     
-    storyforge_url = "http://localhost:3001"
-    
     # Test StoryForge service status
     print("1. StoryForge Service Status...")
     try:
-        response = requests.get(f"{storyforge_url}/api/status/services", timeout=5)
+        if services_probe is not None:
+            response = services_probe.result()
+        else:
+            response = cached_get(f"{STORYFORGE_URL}/api/status/services")
         if response.status_code == 200:
-            status = response.json()
+            status = json_loads(response.content)
             services = status.get('services', {})
             python_status = services.get('python', {})
             
@@ -149,14 +305,18 @@ def main():
     print("🚀 Free Python Stable Diffusion Test Suite")
     print("=" * 50)
     
-    # Test Python service
-    service_ok = test_service()
+    # The StoryForge probe doesn't depend on the SD tests, so it runs while they do
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        services_probe = executor.submit(SESSION.get, f"{STORYFORGE_URL}/api/status/services", timeout=5)
+        
+        # Test Python service
+        service_ok = test_service() and test_batch_generation()
     
     if service_ok:
         print("\n🎉 Python SD Service: ALL TESTS PASSED!")
         
         # Test integration
-        integration_ok = test_integration()
+        integration_ok = test_integration(services_probe)
         
         if integration_ok:
             print("\n🎉 COMPLETE SUCCESS!")